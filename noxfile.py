@@ -1,13 +1,19 @@
+import glob
+import json
 import os
 import re
+import shutil
 import sys
 from functools import lru_cache
 from typing import Any, Dict
 
 import nox
-from nox.command import CommandFailed
 from nox.sessions import Session
-from rtoml import load
+
+if sys.version_info >= (3, 11):
+    import tomllib
+else:
+    import tomli as tomllib
 
 os.environ.update({"PDM_IGNORE_SAVED_PYTHON": "1"})
 
@@ -59,16 +65,22 @@ For more shells refer to:
 """
 
 
+DEP_SEP_PATTERN = re.compile(r"[ <>~=]")
+PYTHON_VERSION_PATTERN = re.compile(r">=\s*(\d+(?:\.\d+)*)")
+DEV_DEPS_CACHE = os.path.join(".nox", ".pyproject_cache.json")
+HAS_TAPLO = shutil.which("taplo") is not None
+
+
 @lru_cache(maxsize=1)
 def get_pyproject_toml() -> Dict[str, Any]:
-    with open("pyproject.toml") as fp:
-        return load(fp)
+    with open("pyproject.toml", "rb") as fp:
+        return tomllib.load(fp)
 
 
 @lru_cache(maxsize=1)
 def get_python_version() -> str:
     pyproject = get_pyproject_toml()
-    if m := re.search(r">=\s*(\d+(\.\d+)*)", pyproject["project"]["requires-python"]):
+    if m := PYTHON_VERSION_PATTERN.search(pyproject["project"]["requires-python"]):
         return m.group(1)
     else:
         return f"{sys.version_info.major}.{sys.version_info.minor}"
@@ -76,25 +88,47 @@ def get_python_version() -> str:
 
 @lru_cache(maxsize=1)
 def get_dev_dependencies() -> Dict[str, str]:
+    # pyproject.toml rarely changes between nox invocations, so reuse the parsed
+    # dev dependencies as long as neither it nor the parsing logic in this file
+    # has been modified since they were cached
+    mtimes = [os.stat("pyproject.toml").st_mtime, os.stat(__file__).st_mtime]
+    try:
+        with open(DEV_DEPS_CACHE) as fp:
+            cache = json.load(fp)
+        deps = cache["deps"]
+        if (
+            cache["mtimes"] == mtimes
+            and isinstance(deps, dict)
+            and all(isinstance(k, str) and isinstance(v, str) for k, v in deps.items())
+        ):
+            return deps
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+
     pyproject = get_pyproject_toml()
-    pat = re.compile(r"[ <>~=]")
     dev_deps: Dict[str, str] = {}
     for dep in pyproject["dependency-groups"]["dev"]:
-        sep = -1
-        for m in pat.finditer(dep):
-            sep = m.span()[0]
-            break
+        m = DEP_SEP_PATTERN.search(dep)
+        sep = m.start() if m else -1
         if sep == -1:
             dev_deps[dep] = dep
         else:
             dev_deps[dep[:sep]] = dep
+
+    try:
+        os.makedirs(os.path.dirname(DEV_DEPS_CACHE), exist_ok=True)
+        with open(DEV_DEPS_CACHE, "w") as fp:
+            json.dump({"mtimes": mtimes, "deps": dev_deps}, fp)
+    except OSError:
+        pass
     return dev_deps
 
 
-AUTOFLAKE_VERSION = get_dev_dependencies()["autoflake"]
-MYPY_VERSION = get_dev_dependencies()["mypy"]
-RUFF_VERSION = get_dev_dependencies()["ruff"]
-SOURCES = ["fluentmap.py", "noxfile.py", "tests"]
+SOURCES = [
+    "fluentmap.py",
+    "noxfile.py",
+    *sorted(glob.glob(os.path.join("tests", "**", "*.py"), recursive=True)),
+]
 
 
 @nox.session(python=False)
@@ -116,9 +150,7 @@ def shell_completion(session: Session):
 
 @nox.session(python=False)
 def clean(session: Session):
-    session.run(
-        "rm",
-        "-rf",
+    for path in (
         ".mypy_cache",
         ".pytype",
         ".pytest_cache",
@@ -128,22 +160,27 @@ def clean(session: Session):
         "html_cov",
         "html_doc",
         "logs",
-    )
-    session.run(
-        "sh",
-        "-c",
-        "find . | grep -E '(__pycache__|\.pyc|\.pyo$$)' | xargs rm -rf",
-    )
+    ):
+        shutil.rmtree(path, ignore_errors=True)
+    for root, dirs, files in os.walk("."):
+        for skipped in (".git", ".venv"):
+            if skipped in dirs:
+                dirs.remove(skipped)
+        if "__pycache__" in dirs:
+            shutil.rmtree(os.path.join(root, "__pycache__"), ignore_errors=True)
+            dirs.remove("__pycache__")
+        for file in files:
+            if file.endswith((".pyc", ".pyo")):
+                os.unlink(os.path.join(root, file))
 
 
 @nox.session(python="3.8", reuse_venv=True)
-@nox.parametrize("autoflake", [AUTOFLAKE_VERSION])
-@nox.parametrize("ruff", [RUFF_VERSION])
-def format(session: Session, autoflake: str, ruff: str):
-    session.install(autoflake, ruff)
-    try:
+def format(session: Session):
+    dev_deps = get_dev_dependencies()
+    session.install(dev_deps["autoflake"], dev_deps["ruff"])
+    if HAS_TAPLO:
         session.run("taplo", "fmt", "pyproject.toml", external=True)
-    except CommandFailed:
+    else:
         session.warn(
             "Seems that `taplo` is not found, skip formatting `pyproject.toml`. "
             "(Refer to https://taplo.tamasfe.dev/ for information on how to install "
@@ -156,13 +193,12 @@ def format(session: Session, autoflake: str, ruff: str):
 
 
 @nox.session(python="3.8", reuse_venv=True)
-@nox.parametrize("autoflake", [AUTOFLAKE_VERSION])
-@nox.parametrize("ruff", [RUFF_VERSION])
-def format_check(session: Session, autoflake: str, ruff: str):
-    session.install(autoflake, ruff)
-    try:
+def format_check(session: Session):
+    dev_deps = get_dev_dependencies()
+    session.install(dev_deps["autoflake"], dev_deps["ruff"])
+    if HAS_TAPLO:
         session.run("taplo", "check", "pyproject.toml", external=True)
-    except CommandFailed:
+    else:
         session.warn(
             "Seems that `taplo` is not found, skip checking `pyproject.toml`. "
             "(Refer to https://taplo.tamasfe.dev/ for information on how to install "
@@ -175,9 +211,8 @@ def format_check(session: Session, autoflake: str, ruff: str):
 
 
 @nox.session(python="3.8", reuse_venv=True)
-@nox.parametrize("mypy", [MYPY_VERSION])
-def mypy(session: Session, mypy: str):
-    session.install(mypy)
+def mypy(session: Session):
+    session.install(get_dev_dependencies()["mypy"])
     session.run("mypy", "--version")
     session.log(
         "If you encountered "
@@ -187,11 +222,6 @@ def mypy(session: Session, mypy: str):
     session.run("mypy", "fluentmap.py", "noxfile.py")
 
 
-@nox.session(python=False)
-def test(session: Session):
-    session.run("pytest", "tests")
-
-
 @nox.session(reuse_venv=True)
 def test_for_ci(session: Session):
     session.install(
@@ -201,5 +231,17 @@ def test_for_ci(session: Session):
         "pytest-cov",
         "pytest-mock",
         "pytest-timeout",
+        "pytest-xdist",
+    )
+    args = list(session.posargs)
+    if not any(arg.startswith(("-n", "--numprocesses")) for arg in args):
+        args = ["-n", "auto", *args]
+    session.run(
+        "pytest",
+        "tests",
+        "--dist=load",
+        "-p",
+        "no:cacheprovider",
+        *args,
+        env={"PYTHONDONTWRITEBYTECODE": "1"},
     )
-    test(session)
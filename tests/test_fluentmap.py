@@ -1,7 +1,17 @@
 import random
 import time
 from concurrent.futures import ThreadPoolExecutor
-from typing import List, Optional, Tuple, Type, TypeVar, Union
+from threading import Condition, Event
+from typing import (
+    Any,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+    TypeVar,
+    Union,
+)
 
 import pytest
 
@@ -12,129 +22,183 @@ from fluentmap import map as fmap
 T = TypeVar("T")
 
 
-def map_func(
-    v: T,
-    *vs: T,
-    wait_time: Optional[float] = None,
-    exc_type: Optional[Type[Exception]] = None,
-) -> Union[T, Tuple[T, ...]]:
-    if exc_type is not None:
-        raise exc_type("mock")
-    if wait_time is not None:
-        time.sleep(wait_time)
-    if vs:
-        return (v, *vs)
+def identity_func(v: T, *vs: T) -> Union[T, Tuple[T, ...]]:
+    return (v, *vs) if vs else v
+
+
+def sleep_func(v: T, wait_time: float) -> T:
+    time.sleep(wait_time)
     return v
 
 
-def test_simple_map():
+# results follow the iteration order of this very set object, rather than assuming
+# that two equal sets iterate in the same order
+SET_ARGS = {0, 1, 2}
+
+MAP_CASES = [
     # should accept zero-arg iterables
-    assert list(fmap(map_func, ())) == list(map(map_func, ()))
+    pytest.param(((),), {}, [], id="empty"),
     # most common case
-    assert list(fmap(map_func, (0, 1, 2))) == list(map(map_func, (0, 1, 2)))
+    pytest.param(((0, 1, 2),), {}, [0, 1, 2], id="tuple"),
     # should accept set
-    assert list(fmap(map_func, {0, 1, 2})) == list(map(map_func, {0, 1, 2}))
+    pytest.param((SET_ARGS,), {}, list(SET_ARGS), id="set"),
     # should accept str
-    assert list(fmap(map_func, "012")) == list(map(map_func, "012"))
+    pytest.param(("012",), {}, ["0", "1", "2"], id="str"),
     # should accpet range
-    assert list(fmap(map_func, range(6), batch_size=0)) == list(range(6))
+    pytest.param((range(6),), {"batch_size": 0}, list(range(6)), id="range"),
     # should accept iterables of iterables
-    assert list(fmap(map_func, ((0, 0), (1, 1)))) == list(
-        map(map_func, ((0, 0), (1, 1)))
-    )
+    pytest.param((((0, 0), (1, 1)),), {}, [(0, 0), (1, 1)], id="nested"),
     # should have same behavior with builtin map on receiving multiple iterables of
     # different length
-    assert list(fmap(map_func, (0, 1, 2), (3, 4))) == list(
-        map(map_func, (0, 1, 2), (3, 4))
-    )
+    pytest.param(((0, 1, 2), (3, 4)), {}, [(0, 3), (1, 4)], id="multiple"),
     # should accept multiple iterables of iterables of different length
-    assert list(fmap(map_func, ((0, 0), (1, 1), (2, 2)), ((3, 3), (4, 4)))) == list(
-        map(
-            map_func,
-            ((0, 0), (1, 1), (2, 2)),
-            ((3, 3), (4, 4)),
-        )
-    )
+    pytest.param(
+        (((0, 0), (1, 1), (2, 2)), ((3, 3), (4, 4))),
+        {},
+        [((0, 0), (3, 3)), ((1, 1), (4, 4))],
+        id="multiple-nested",
+    ),
     # test of batch_size
-    assert list(fmap(map_func, range(6), batch_size=3)) == [
-        [0, 1, 2],
-        [3, 4, 5],
-    ]
+    pytest.param(
+        (range(6),),
+        {"batch_size": 3},
+        [[0, 1, 2], [3, 4, 5]],
+        id="batch",
+    ),
     # test of batches that cannot be rounded
-    assert list(fmap(map_func, range(7), batch_size=3)) == [
-        [0, 1, 2],
-        [3, 4, 5],
-        [6],
-    ]
+    pytest.param(
+        (range(7),),
+        {"batch_size": 3},
+        [[0, 1, 2], [3, 4, 5], [6]],
+        id="batch-unrounded",
+    ),
     # test of batches of iterables that cannot be rounded
-    assert list(fmap(map_func, [(i, i) for i in range(7)], batch_size=3)) == [
-        [(0, 0), (1, 1), (2, 2)],
-        [(3, 3), (4, 4), (5, 5)],
-        [(6, 6)],
-    ]
+    pytest.param(
+        ([(i, i) for i in range(7)],),
+        {"batch_size": 3},
+        [[(0, 0), (1, 1), (2, 2)], [(3, 3), (4, 4), (5, 5)], [(6, 6)]],
+        id="batch-nested-unrounded",
+    ),
     # test of on_return
-    assert list(fmap(map_func, (0, 1, 2), on_return=lambda x: x + 1)) == [1, 2, 3]
-    # test of combination of batch_size and on_return
-    assert list(
-        fmap(
-            map_func,
-            range(7),
-            batch_size=3,
-            on_return=lambda row: [x + 1 for x in row],
-        )
-    ) == [
+    pytest.param(
+        ((0, 1, 2),),
+        {"on_return": lambda x: x + 1},
         [1, 2, 3],
-        [4, 5, 6],
-        [7],
-    ]
-    # test of combination of Arguments and on_return
-    assert list(
-        fmap(
-            map_func,
-            [Arguments(i, i) for i in range(2)],
-            on_return=lambda row: [x + 1 for x in row],
-        )
-    ) == [[1, 1], [2, 2]]
-
-    # test num_prepare works
-    assert list(fmap(map_func, (0, 1, 2), num_prepare=1)) == [0, 1, 2]
-    assert list(fmap(map_func, (0, 1, 2), num_prepare=2)) == [0, 1, 2]
+        id="on_return",
+    ),
+    # test of combination of batch_size and on_return
+    pytest.param(
+        (range(7),),
+        {"batch_size": 3, "on_return": lambda row: [x + 1 for x in row]},
+        [[1, 2, 3], [4, 5, 6], [7]],
+        id="batch-on_return",
+    ),
+]
 
-    track: List[int]
 
-    def yield_data(n: int):
-        for i in range(n):
+def tracked_range(n: int, track: List[int], cond: Condition) -> Iterator[int]:
+    for i in range(n):
+        with cond:
             track.append(i)
-            yield i
+            cond.notify_all()
+        yield i
+
+
+def wait_for_track(track: List[int], cond: Condition, size: int) -> None:
+    # block a slow callback until the producer has pulled enough items to be
+    # stalled by num_prepare (or exhausted), instead of sleeping for it
+    with cond:
+        cond.wait_for(lambda: len(track) >= size, timeout=2)
+
 
-    def func1(res: int):
+def chained_func(
+    v: T,
+    wait: Optional[Event] = None,
+    done: Optional[Event] = None,
+) -> T:
+    if wait is not None:
+        wait.wait(timeout=2)
+    if done is not None:
+        done.set()
+    return v
+
+
+@pytest.fixture(scope="module")
+def executor() -> Iterator[ThreadPoolExecutor]:
+    with ThreadPoolExecutor() as executor:
+        yield executor
+
+
+@pytest.mark.parametrize(
+    "iterables, kwargs, expected",
+    [
+        *MAP_CASES,
+        # test of combination of Arguments and on_return
+        pytest.param(
+            ([Arguments(i, i) for i in range(2)],),
+            {"on_return": lambda row: [x + 1 for x in row]},
+            [[1, 1], [2, 2]],
+            id="arguments-on_return",
+        ),
+        # test num_prepare works
+        pytest.param(((0, 1, 2),), {"num_prepare": 1}, [0, 1, 2], id="prepare-1"),
+        pytest.param(((0, 1, 2),), {"num_prepare": 2}, [0, 1, 2], id="prepare-2"),
+    ],
+)
+def test_simple_map(iterables: Tuple[Iterable[Any], ...], kwargs, expected):
+    assert list(fmap(identity_func, *iterables, **kwargs)) == expected
+
+
+def test_simple_map_prepare_all():
+    track: List[int] = []
+    cond = Condition()
+
+    def func(res: int):
         if res == 0:
-            time.sleep(0.15)
+            wait_for_track(track, cond, 2)
         track.append(-1)
         return res
 
-    track = []
-    assert list(fmap(func1, yield_data(2), num_prepare=2)) == [0, 1]
+    assert list(fmap(func, tracked_range(2, track, cond), num_prepare=2)) == [0, 1]
     assert track == [0, 1, -1, -1]
 
-    def func2(res: int):
-        if res < 2:
-            time.sleep(0.15)
+
+def test_simple_map_prepare_partial():
+    track: List[int] = []
+    cond = Condition()
+
+    def func(res: int):
+        if res == 0:
+            wait_for_track(track, cond, 3)
+        elif res == 1:
+            wait_for_track(track, cond, 5)
         track.append(-1)
         return res
 
-    track = []
-    assert list(fmap(func2, yield_data(4), num_prepare=2)) == [0, 1, 2, 3]
+    assert list(fmap(func, tracked_range(4, track, cond), num_prepare=2)) == [
+        0,
+        1,
+        2,
+        3,
+    ]
     assert track == [0, 1, 2, -1, 3, -1, -1, -1]
 
-    def func3(res: List[int]):
-        if res == [0, 1] or res == [2, 3]:
-            time.sleep(0.15)
+
+def test_simple_map_prepare_batch():
+    track: List[int] = []
+    cond = Condition()
+
+    def func(res: List[int]):
+        if res == [0, 1]:
+            wait_for_track(track, cond, 8)
+        elif res == [2, 3]:
+            wait_for_track(track, cond, 10)
         track.append(-1)
         return res
 
-    track = []
-    assert list(fmap(func3, yield_data(9), batch_size=2, num_prepare=3)) == [
+    assert list(
+        fmap(func, tracked_range(9, track, cond), batch_size=2, num_prepare=3)
+    ) == [
         [0, 1],
         [2, 3],
         [4, 5],
@@ -143,145 +207,83 @@ def test_simple_map():
     ]
     assert track == [0, 1, 2, 3, 4, 5, 6, 7, -1, 8, -1, -1, -1, -1]
 
-    # test imap stop asap
-    def process_exc(res: List[int]):
-        time.sleep(0.15)
+
+def test_simple_map_stop_asap():
+    track: List[int] = []
+    cond = Condition()
+
+    def func(res: List[int]):
+        wait_for_track(track, cond, 6)
         track.append(-1)
         raise RuntimeError("mock")
 
-    track = []
     with pytest.raises(RuntimeError):
-        _ = list(fmap(process_exc, yield_data(9), batch_size=2, num_prepare=2))
+        _ = list(fmap(func, tracked_range(9, track, cond), batch_size=2, num_prepare=2))
     assert len(track) in (7, 8)
     assert track[:7] == [0, 1, 2, 3, 4, 5, -1]
     if len(track) == 8:
         assert track[7] == 6
 
 
-def test_concurrent_map():
-    with ThreadPoolExecutor(max_workers=256) as executor:
-        # should accept zero-arg iterables
-        assert list(fmap(map_func, (), executor=executor)) == list(map(map_func, ()))
-        # most common case
-        assert list(fmap(map_func, (0, 1, 2), executor=executor)) == list(
-            map(map_func, (0, 1, 2))
-        )
-        # should accept set
-        assert list(fmap(map_func, {0, 1, 2}, executor=executor)) == list(
-            map(map_func, {0, 1, 2})
-        )
-        # should accept str
-        assert list(fmap(map_func, "012", executor=executor)) == list(
-            map(map_func, "012")
-        )
-        # should accpet range
-        assert list(
-            fmap(
-                map_func,
-                range(6),
-                batch_size=0,
-                executor=executor,
-            )
-        ) == list(range(6))
-        # should accept iterables of iterables
-        assert list(fmap(map_func, ((0, 0), (1, 1)), executor=executor)) == list(
-            map(map_func, ((0, 0), (1, 1)))
-        )
-        # should have same behavior with builtin map on receiving multiple iterables of
-        # different length
-        assert list(fmap(map_func, (0, 1, 2), (3, 4), executor=executor)) == list(
-            map(map_func, (0, 1, 2), (3, 4))
-        )
-        # should accept multiple iterables of iterables of different length
-        assert list(
-            fmap(
-                map_func,
-                ((0, 0), (1, 1), (2, 2)),
-                ((3, 3), (4, 4)),
-                executor=executor,
-            )
-        ) == list(
-            map(
-                map_func,
-                ((0, 0), (1, 1), (2, 2)),
-                ((3, 3), (4, 4)),
-            )
-        )
-        # test of batch_size
-        assert list(fmap(map_func, range(6), batch_size=3, executor=executor)) == [
-            [0, 1, 2],
-            [3, 4, 5],
-        ]
-        # test of batches that cannot be rounded
-        assert list(fmap(map_func, range(7), batch_size=3, executor=executor)) == [
-            [0, 1, 2],
-            [3, 4, 5],
-            [6],
-        ]
-        # test of batches of iterables that cannot be rounded
-        assert list(
-            fmap(
-                map_func,
-                [(i, i) for i in range(7)],
-                batch_size=3,
-                executor=executor,
-            )
-        ) == [
-            [(0, 0), (1, 1), (2, 2)],
-            [(3, 3), (4, 4), (5, 5)],
-            [(6, 6)],
-        ]
-        # test of on_return
-        assert list(
-            fmap(map_func, (0, 1, 2), executor=executor, on_return=lambda x: x + 1)
-        ) == [1, 2, 3]
-        # test of combination of batch_size and on_return
-        assert list(
-            fmap(
-                map_func,
-                range(7),
-                batch_size=3,
-                executor=executor,
-                on_return=lambda row: [x + 1 for x in row],
-            )
-        ) == [
-            [1, 2, 3],
-            [4, 5, 6],
-            [7],
-        ]
-        # test of combination of Arguments
-        assert list(
-            fmap(
-                map_func,
-                [Arguments(i, wait_time=0.4 - 0.2 * i) for i in range(3)],
-                executor=executor,
-            )
-        ) == [0, 1, 2]
+@pytest.mark.parametrize("iterables, kwargs, expected", MAP_CASES)
+def test_concurrent_map(
+    executor: ThreadPoolExecutor,
+    iterables: Tuple[Iterable[Any], ...],
+    kwargs,
+    expected,
+):
+    assert (
+        list(fmap(identity_func, *iterables, executor=executor, **kwargs)) == expected
+    )
+
+
+def test_concurrent_map_arguments(executor: ThreadPoolExecutor):
+    # test of combination of Arguments, each call waits for the next one to finish
+    # so that they complete in reverse order
+    done = [Event() for _ in range(3)]
+    args = [
+        Arguments(i, wait=done[i + 1] if i < 2 else None, done=done[i])
+        for i in range(3)
+    ]
+    assert list(fmap(chained_func, args, executor=executor)) == [0, 1, 2]
+
+
+@pytest.mark.parametrize(
+    "kwargs, expected",
+    [
         # result should be inversed when sort_by_completion=True
-        assert list(
-            fmap(
-                map_func,
-                [Arguments(i, wait_time=0.4 - 0.2 * i) for i in range(3)],
-                executor=executor,
-                sort_by_completion=True,
-            )
-        ) == [2, 1, 0]
+        pytest.param({}, [2, 1, 0], id="plain"),
         # test of combination of sort_by_completion=True and on_return
+        pytest.param({"on_return": lambda x: x + 1}, [3, 2, 1], id="on_return"),
+    ],
+)
+def test_concurrent_map_sort_by_completion(
+    executor: ThreadPoolExecutor, kwargs, expected
+):
+    # each call is released only after the previous completion has been yielded
+    yielded = [Event() for _ in range(3)]
+    args = [Arguments(i, wait=yielded[1 - i] if i < 2 else None) for i in range(3)]
+    results = []
+    for res in fmap(
+        chained_func,
+        args,
+        executor=executor,
+        sort_by_completion=True,
+        **kwargs,
+    ):
+        yielded[len(results)].set()
+        results.append(res)
+    assert results == expected
+
+
+def test_concurrent_map_high_concurrency():
+    # test integrity of high-concurrency situation
+    with ThreadPoolExecutor(max_workers=256) as executor:
         assert list(
             fmap(
-                map_func,
-                [Arguments(i, wait_time=0.4 - 0.2 * i) for i in range(3)],
-                executor=executor,
-                sort_by_completion=True,
-                on_return=lambda x: x + 1,
-            )
-        ) == [3, 2, 1]
-        # test integrity of high-concurrency situation
-        assert list(
-            fmap(
-                map_func,
-                [Arguments(i, wait_time=random.random()) for i in range(1024)],
+                sleep_func,
+                [Arguments(i, wait_time=random.random()) for i in range(256)],
                 executor=executor,
                 on_return=lambda x: x + 1,
             )
-        ) == list(range(1, 1025))
+        ) == list(range(1, 257))